@@ -3,10 +3,24 @@ import os
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.model import JsonModel
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import functools
+import google_auth_httplib2
+import hashlib
+import httplib2
+import json
+import orjson
 import pickle
+import re
+import sqlite3
+import threading
 import time
+import unicodedata
 
 # Load environment variables from .env file
 load_dotenv()
@@ -14,6 +28,53 @@ load_dotenv()
 # YouTube OAuth scopes
 YOUTUBE_SCOPES = ['https://www.googleapis.com/auth/youtube.force-ssl']
 
+# Refresh the YouTube token this long before it actually expires
+TOKEN_EXPIRY_BUFFER = timedelta(minutes=5)
+
+# Built YouTube service, reused for as long as its token stays valid
+_YT_SERVICE = None
+
+# Number of YouTube searches to run at the same time
+SEARCH_WORKERS = 8
+
+# httplib2 connections are not thread safe, so each worker thread gets its own
+_thread_local = threading.local()
+
+# YouTube accepts at most 50 sub-requests per batch
+BATCH_SIZE = 50
+
+# Rate limited / temporarily unavailable responses are worth retrying
+RETRY_STATUSES = (429, 503)
+MAX_RETRIES = 5
+
+# Concurrent inserts into one playlist can also fail with 409 (ABORTED) or 500 (backendError)
+BATCH_RETRY_STATUSES = RETRY_STATUSES + (409, 500)
+
+# Search results are cached on disk so reruns don't spend quota again
+SEARCH_CACHE_FILE = 'yt_cache.sqlite'
+SEARCH_CACHE_TTL = 30 * 24 * 60 * 60  # 30 days
+
+_cache = sqlite3.connect(SEARCH_CACHE_FILE, check_same_thread=False)
+_cache.execute("CREATE TABLE IF NOT EXISTS search_cache "
+               "(norm_query TEXT PRIMARY KEY, results TEXT, ts REAL)")
+_cache_lock = threading.Lock()
+
+# Only ask Spotify for the fields we actually read (skips markets, images, ...)
+PLAYLIST_FIELDS = 'name,owner(display_name),tracks(total)'
+PLAYLIST_TRACK_FIELDS = ('next,items(track(name,duration_ms,external_urls.spotify,'
+                         'artists(name),album(name)))')
+
+# Minimum candidate score to count as a confident match
+MATCH_THRESHOLD = 0.6
+
+# Weights for artist match, track name match and auto-generated "- Topic" channel
+ARTIST_WEIGHT = 0.5
+NAME_WEIGHT = 0.3
+TOPIC_WEIGHT = 0.2
+
+# Featuring markers in Spotify names that a matching YouTube title may leave out
+FEATURING_WORDS = {'feat', 'ft', 'featuring'}
+
 # Set up Spotify authentication
 sp = spotipy.Spotify(auth_manager=SpotifyOAuth(
     client_id=os.getenv('SPOTIFY_CLIENT_ID'),
@@ -23,18 +84,60 @@ sp = spotipy.Spotify(auth_manager=SpotifyOAuth(
 ))
 
 
+class OrjsonModel(JsonModel):
+    """YouTube API response model that decodes JSON with orjson"""
+
+    def deserialize(self, content):
+        try:
+            body = orjson.loads(content)
+        except orjson.JSONDecodeError:
+            return super().deserialize(content)
+        if self._data_wrapper and 'data' in body:
+            body = body['data']
+        return body
+
+
+def token_expiring(creds):
+    """Check whether credentials expire within TOKEN_EXPIRY_BUFFER"""
+    # google-auth stores expiry as a naive UTC datetime
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return creds.expiry is not None and creds.expiry - now < TOKEN_EXPIRY_BUFFER
+
+
+def get_token_file():
+    """Token pickle for the current client_secret.json, so a new OAuth client gets its own token"""
+    if not os.path.exists('client_secret.json'):
+        return 'youtube_token.pickle'
+    with open('client_secret.json', 'rb') as secret:
+        key = hashlib.sha256(secret.read()).hexdigest()[:16]
+    return f'youtube_token_{key}.pickle'
+
+
 def get_youtube_service():
     """Authenticate with YouTube and return service object"""
+    global _YT_SERVICE
     creds = None
 
-    # Token file stores user's access and refresh tokens
-    if os.path.exists('youtube_token.pickle'):
-        with open('youtube_token.pickle', 'rb') as token:
-            creds = pickle.load(token)
+    if _YT_SERVICE is not None:
+        # Reuse the in-memory service while its token is still fresh
+        creds = _YT_SERVICE._http.credentials
+        if creds.valid and not token_expiring(creds):
+            return _YT_SERVICE
+
+    token_file = get_token_file()
+
+    # Only read a token from disk on a cold start
+    if creds is None:
+        # Token file stores user's access and refresh tokens (older runs used the unkeyed name)
+        for path in (token_file, 'youtube_token.pickle'):
+            if os.path.exists(path):
+                with open(path, 'rb') as token:
+                    creds = pickle.load(token)
+                break
 
     # If no valid credentials, let user log in
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
+    if not creds or not creds.valid or token_expiring(creds):
+        if creds and creds.refresh_token:
             creds.refresh(Request())
         else:
             # Need client_secret.json from Google Cloud Console
@@ -52,10 +155,11 @@ def get_youtube_service():
             creds = flow.run_local_server(port=8080)
 
         # Save credentials for next run
-        with open('youtube_token.pickle', 'wb') as token:
+        with open(token_file, 'wb') as token:
             pickle.dump(creds, token)
 
-    return build('youtube', 'v3', credentials=creds)
+    _YT_SERVICE = build('youtube', 'v3', credentials=creds, model=OrjsonModel())
+    return _YT_SERVICE
 
 
 def extract_playlist_id(url):
@@ -67,10 +171,21 @@ def extract_playlist_id(url):
     return playlist_id
 
 
-def get_playlist_tracks(playlist_id):
-    """Fetch all tracks from a Spotify playlist"""
+def iter_playlist_items(playlist_id):
+    """Yield playlist items page by page, fetching the next page in the background"""
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        results = sp.playlist_tracks(playlist_id, fields=PLAYLIST_TRACK_FIELDS)
+
+        while results:
+            future = executor.submit(sp.next, results) if results['next'] else None
+            yield from results['items']
+            results = future.result() if future else None
+
+
+def get_playlist_info(playlist_id):
+    """Fetch a Spotify playlist's details and return its name"""
     try:
-        playlist = sp.playlist(playlist_id)
+        playlist = sp.playlist(playlist_id, fields=PLAYLIST_FIELDS)
 
         playlist_name = playlist['name']
         playlist_owner = playlist['owner']['display_name']
@@ -79,53 +194,151 @@ def get_playlist_tracks(playlist_id):
         print(f"Owner: {playlist_owner}")
         print(f"Total tracks: {playlist['tracks']['total']}\n")
 
-        results = sp.playlist_tracks(playlist_id)
-        tracks = results['items']
+        return playlist_name
+
+    except spotipy.exceptions.SpotifyException as e:
+        print(f"Error fetching playlist: {e}")
+        return None
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+        return None
 
-        while results['next']:
-            results = sp.next(results)
-            tracks.extend(results['items'])
 
+def get_playlist_tracks(playlist_id):
+    """Fetch all tracks from a Spotify playlist"""
+    try:
         track_list = []
-        for index, item in enumerate(tracks, 1):
+        for index, item in enumerate(iter_playlist_items(playlist_id), 1):
             track = item['track']
 
             if track is None:
                 continue
 
+            artist_names = [artist['name'] for artist in track['artists']]
+
             track_info = {
                 'number': index,
                 'name': track['name'],
-                'artist': track['artists'][0]['name'],
-                'all_artists': ', '.join([artist['name'] for artist in track['artists']]),
+                'artist': artist_names[0],
+                'all_artists': ', '.join(artist_names),
                 'album': track['album']['name'],
                 'duration_ms': track['duration_ms'],
                 'spotify_url': track['external_urls']['spotify']
             }
 
+            # Precompute matching keys so the search loop doesn't rebuild them
+            track_info['query'] = f"{track_info['artist']} {track_info['name']}"
+            track_info['query_key'] = normalize_query(track_info['query'])
+            track_info['artist_tokens'] = tokenize_track(track_info['artist'])
+            track_info['name_tokens'] = tokenize_track(track_info['name'])
+
             track_list.append(track_info)
-            print(f"{index}. {track_info['artist']} - {track_info['name']}")
 
-        return playlist_name, track_list
+        return track_list
 
     except spotipy.exceptions.SpotifyException as e:
         print(f"Error fetching playlist: {e}")
-        return None, None
+        return None
     except Exception as e:
         print(f"Unexpected error: {e}")
-        return None, None
+        return None
+
+
+def get_retry_delay(error, attempt):
+    """Seconds to wait before retrying, honoring Retry-After when present"""
+    retry_after = error.resp.get('retry-after', '')
+    if retry_after.isdigit():
+        return int(retry_after)
+    return 2 ** attempt
+
+
+def retry_on_rate_limit(func):
+    """Retry a YouTube API call on 429/503 with exponential backoff"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(MAX_RETRIES):
+            try:
+                return func(*args, **kwargs)
+            except HttpError as e:
+                if e.resp.status not in RETRY_STATUSES:
+                    raise
+                time.sleep(get_retry_delay(e, attempt))
+        return func(*args, **kwargs)
+    return wrapper
+
+
+@retry_on_rate_limit
+def execute_request(request, http=None):
+    """Execute a YouTube API (or batch) request, retrying when rate limited"""
+    return request.execute(http=http)
+
+
+def get_thread_http(youtube):
+    """Return an authorized HTTP object owned by the current thread"""
+    if not hasattr(_thread_local, 'http'):
+        _thread_local.http = google_auth_httplib2.AuthorizedHttp(
+            youtube._http.credentials, http=httplib2.Http())
+    return _thread_local.http
+
+
+def normalize_query(query):
+    """Case-fold a search query and strip Latin accents for use as a cache key"""
+    chars = []
+    for char in unicodedata.normalize('NFKD', query):
+        # Only drop accents on Latin letters; other marks (kana voicing, Cyrillic й) change the word
+        if '\u0300' <= char <= '\u036f' and chars and chars[-1] < '\u0250':
+            continue
+        chars.append(char)
+    return unicodedata.normalize('NFC', ''.join(chars)).casefold()
+
+
+def tokenize(text):
+    """Split text into a set of lower-cased, accent-free words"""
+    return set(re.findall(r'\w+', normalize_query(text)))
+
+
+def tokenize_track(text):
+    """Tokenize a Spotify artist or track name without featuring markers"""
+    tokens = tokenize(text)
+    # A name made only of those words (e.g. "Ft.") still has to match itself
+    return tokens - FEATURING_WORDS or tokens
+
+
+def jaccard(track_tokens, title_tokens):
+    """Modified Jaccard similarity: share of track_tokens found in title_tokens"""
+    if not track_tokens:
+        return 0.0
+    return len(track_tokens & title_tokens) / len(track_tokens)
+
+
+def score_candidate(artist_tokens, name_tokens, result):
+    """Weighted score of how well a YouTube result matches a track"""
+    title_tokens = tokenize(result['title'])
+    # Auto-generated "Artist - Topic" uploads only name the artist in the channel
+    channel_tokens = tokenize(result['channel']) - {'topic'}
+    return (ARTIST_WEIGHT * jaccard(artist_tokens, title_tokens | channel_tokens)
+            + NAME_WEIGHT * jaccard(name_tokens, title_tokens)
+            + TOPIC_WEIGHT * result['channel'].endswith('- Topic'))
 
 
 def search_youtube(youtube, query, max_results=5):
     """Search YouTube for a track and return video results"""
+    key = normalize_query(query)
+
+    with _cache_lock:
+        row = _cache.execute("SELECT results, ts FROM search_cache WHERE norm_query = ?",
+                             (key,)).fetchone()
+    if row and time.time() - row[1] < SEARCH_CACHE_TTL:
+        return json.loads(row[0])
+
     try:
-        search_response = youtube.search().list(
+        search_response = execute_request(youtube.search().list(
             q=query,
             part='id,snippet',
             maxResults=max_results,
             type='video',
-            videoCategoryId='10'  # Music category
-        ).execute()
+            fields='items(id/videoId,snippet(title,channelTitle))'
+        ), http=get_thread_http(youtube))
 
         results = []
         for item in search_response.get('items', []):
@@ -140,6 +353,11 @@ def search_youtube(youtube, query, max_results=5):
                 'url': f'https://www.youtube.com/watch?v={video_id}'
             })
 
+        with _cache_lock:
+            _cache.execute("INSERT OR REPLACE INTO search_cache VALUES (?, ?, ?)",
+                           (key, json.dumps(results), time.time()))
+            _cache.commit()
+
         return results
 
     except Exception as e:
@@ -155,46 +373,47 @@ def find_youtube_matches(youtube, tracks):
 
     matches = []
     not_found = []
+    log = []
 
-    for track in tracks:
-        # Construct search query
-        query = f"{track['artist']} {track['name']}"
+    # Tracks whose queries only differ by case or Latin accents are only searched once
+    queries = {track['query_key']: track['query'] for track in tracks}
 
-        print(f"[*] Searching: {track['artist']} - {track['name']}")
+    # Searches are network bound, so run several at once
+    with ThreadPoolExecutor(max_workers=SEARCH_WORKERS) as executor:
+        all_results = dict(zip(queries, executor.map(
+            lambda query: search_youtube(youtube, query), queries.values())))
 
-        # Search YouTube
-        results = search_youtube(youtube, query)
+    for track in tracks:
+        results = all_results[track['query_key']]
+        log.append(f"[*] Searching: {track['artist']} - {track['name']}")
 
         if results:
-            # Take the first result (most relevant)
-            best_match = results[0]
-
-            # Check if it looks like the right match
-            track_lower = track['name'].lower()
-            artist_lower = track['artist'].lower()
-            title_lower = best_match['title'].lower()
-
-            # Simple relevance check
-            if track_lower in title_lower or artist_lower in title_lower:
-                print(f"    [+] Found: {best_match['title']}")
+            # Score every candidate and keep the best (ties keep YouTube's ranking)
+            scores = [score_candidate(track['artist_tokens'], track['name_tokens'], result)
+                      for result in results]
+            best_score = max(scores)
+            best_match = results[scores.index(best_score)]
+
+            if best_score > MATCH_THRESHOLD:
+                log.append(f"    [+] Found: {best_match['title']}")
                 matches.append({
                     'track': track,
                     'youtube': best_match,
                     'confidence': 'high'
                 })
             else:
-                print(f"    [!] Uncertain match: {best_match['title']}")
+                log.append(f"    [!] Uncertain match: {best_match['title']}")
                 matches.append({
                     'track': track,
                     'youtube': best_match,
                     'confidence': 'low'
                 })
         else:
-            print(f"    [-] Not found")
+            log.append(f"    [-] Not found")
             not_found.append(track)
 
-        # Rate limiting - be nice to YouTube API
-        time.sleep(0.5)
+    # Print the whole report at once instead of flushing a few lines per track
+    print("\n".join(log))
 
     print(f"\n[+] Found: {len(matches)} tracks")
     print(f"[-] Not found: {len(not_found)} tracks")
@@ -217,7 +436,7 @@ def create_youtube_playlist(youtube, title, description=""):
                 }
             }
         )
-        response = request.execute()
+        response = execute_request(request)
 
         playlist_id = response['id']
         print(f"\n[+] Created YouTube playlist: {title}")
@@ -234,32 +453,68 @@ def create_youtube_playlist(youtube, title, description=""):
 def add_videos_to_playlist(youtube, playlist_id, video_ids):
     """Add multiple videos to a YouTube playlist"""
     print(f"\nAdding {len(video_ids)} videos to playlist...")
+    print("[!] Videos are added in batches, so their order may differ from the Spotify playlist")
 
     added = 0
     failed = 0
-
-    for video_id in video_ids:
-        try:
-            youtube.playlistItems().insert(
-                part='snippet',
-                body={
-                    'snippet': {
-                        'playlistId': playlist_id,
-                        'resourceId': {
-                            'kind': 'youtube#video',
-                            'videoId': video_id
+    pending = list(video_ids)
+
+    for attempt in range(MAX_RETRIES + 1):
+        retry = []
+        delay = 0
+
+        for start in range(0, len(pending), BATCH_SIZE):
+            chunk = pending[start:start + BATCH_SIZE]
+            log = []
+
+            def on_done(request_id, response, exception):
+                nonlocal added, failed, delay
+                if exception is None:
+                    added += 1
+                    log.append(f"  [+] Added video {added}/{len(video_ids)}")
+                elif (isinstance(exception, HttpError)
+                      and exception.resp.status in BATCH_RETRY_STATUSES
+                      and attempt < MAX_RETRIES):
+                    retry.append(chunk[int(request_id)])
+                    delay = max(delay, get_retry_delay(exception, attempt))
+                else:
+                    failed += 1
+                    log.append(f"  [-] Failed to add video: {exception}")
+
+            # Pack the whole chunk into a single HTTP round-trip
+            batch = youtube.new_batch_http_request(callback=on_done)
+            for index, video_id in enumerate(chunk):
+                batch.add(youtube.playlistItems().insert(
+                    part='snippet',
+                    body={
+                        'snippet': {
+                            'playlistId': playlist_id,
+                            'resourceId': {
+                                'kind': 'youtube#video',
+                                'videoId': video_id
+                            }
                         }
                     }
-                }
-            ).execute()
+                ), request_id=str(index))
+
+            try:
+                execute_request(batch)
+            except Exception as e:
+                # The batch raises before running any callback, so none of the chunk was counted
+                failed += len(chunk)
+                log.append(f"  [-] Failed to add {len(chunk)} videos: {e}")
 
-            added += 1
-            print(f"  [+] Added video {added}/{len(video_ids)}")
-            time.sleep(0.3)  # Rate limiting
+            # One write per batch instead of one per video
+            if log:
+                print("\n".join(log))
 
-        except Exception as e:
-            failed += 1
-            print(f"  [-] Failed to add video: {e}")
+        if not retry:
+            break
+
+        print(f"  [!] Retrying {len(retry)} videos in {delay}s "
+              f"(they will be added at the end of the playlist)...")
+        time.sleep(delay)
+        pending = retry
 
     print(f"\n[+] Successfully added {added} videos")
     if failed > 0:
@@ -278,18 +533,29 @@ def main():
     playlist_id = extract_playlist_id(url)
 
     print(f"\n[*] Fetching Spotify playlist...")
-    playlist_name, tracks = get_playlist_tracks(playlist_id)
+    # Runs on this thread so the Spotify login finishes before YouTube's starts
+    playlist_name = get_playlist_info(playlist_id)
+
+    if playlist_name is None:
+        print("[-] Failed to fetch playlist.")
+        return
+
+    # Step 2: Authenticate with YouTube while the tracks are fetched in the background
+    print("[*] Authenticating with YouTube...")
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        tracks_future = executor.submit(get_playlist_tracks, playlist_id)
+        youtube = get_youtube_service()
+        tracks = tracks_future.result()
 
     if not tracks:
         print("[-] Failed to fetch playlist.")
         return
 
+    # Listed only now so the tracks can't bury YouTube's login prompt
+    print("\n" + "\n".join(f"{track['number']}. {track['artist']} - {track['name']}"
+                           for track in tracks))
     print(f"\n[+] Successfully fetched {len(tracks)} tracks!")
 
-    # Step 2: Authenticate with YouTube
-    print("\n[*] Authenticating with YouTube...")
-    youtube = get_youtube_service()
-
     if not youtube:
         print("[-] YouTube authentication failed.")
         return